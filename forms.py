@@ -1,33 +1,36 @@
 from flask_wtf import FlaskForm
 from wtforms import StringField, SubmitField, PasswordField
-from wtforms.validators import DataRequired, URL
+from wtforms.validators import DataRequired, URL, Length
 from flask_ckeditor import CKEditorField
 
+# Validators are stateless, so every required field shares this one instance
+REQUIRED = (DataRequired(),)
+
 
 # WTForm for creating a blog post
 class CreatePostForm(FlaskForm):
-    name = StringField("Cafe Name", validators=[DataRequired()])
-    address = StringField("Address", validators=[DataRequired()])
-    hours = StringField("Hours", validators=[DataRequired()])
-    location = StringField("Location", validators=[DataRequired()])
+    name = StringField("Cafe Name", validators=REQUIRED)
+    address = StringField("Address", validators=REQUIRED)
+    hours = StringField("Hours", validators=REQUIRED)
+    location = StringField("Location", validators=REQUIRED + (Length(max=500),))
     submit = SubmitField("Submit Post")
 
 # Create a form to register new users
 class RegisterForm(FlaskForm):
-    email = StringField("Email", validators=[DataRequired()])
-    password = PasswordField("Password", validators=[DataRequired()])
-    name = StringField("Name", validators=[DataRequired()])
+    email = StringField("Email", validators=REQUIRED)
+    password = PasswordField("Password", validators=REQUIRED)
+    name = StringField("Name", validators=REQUIRED)
     submit = SubmitField("Sign Me Up!")
 
 
 # Create a form to login existing users
 class LoginForm(FlaskForm):
-    email = StringField("Email", validators=[DataRequired()])
-    password = PasswordField("Password", validators=[DataRequired()])
+    email = StringField("Email", validators=REQUIRED)
+    password = PasswordField("Password", validators=REQUIRED)
     submit = SubmitField("Let Me In!")
 
 
 # Create a form to add comments
 class CommentForm(FlaskForm):
-    comment_text = CKEditorField("Comment", validators=[DataRequired()])
+    comment_text = CKEditorField("Comment", validators=REQUIRED)
     submit = SubmitField("Submit Comment")
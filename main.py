@@ -1,21 +1,66 @@
-from flask import Flask, abort, render_template, redirect, url_for, flash
-from flask_bootstrap import Bootstrap5
+from flask import Flask, abort, render_template, redirect, url_for, flash, request, send_from_directory, g
 from flask_ckeditor import CKEditor
-from flask_gravatar import Gravatar
+from flask_session import Session
+from flask_caching import Cache
 from flask_login import UserMixin, login_user, LoginManager, current_user, logout_user
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.orm import relationship, DeclarativeBase, Mapped, mapped_column
-from sqlalchemy import Integer, String, Text, ForeignKey
+from sqlalchemy.orm import relationship, DeclarativeBase, Mapped, mapped_column, joinedload, raiseload
+from sqlalchemy import Integer, String, ForeignKey
 from functools import wraps
+from cachetools import TTLCache
 from werkzeug.security import generate_password_hash, check_password_hash
 # Import your forms from the forms.py
 from forms import CreatePostForm, RegisterForm, LoginForm
+import click
+import gzip
+import hashlib
+import json
 import os
+import redis
+import threading
+from jinja2 import FileSystemBytecodeCache
 
-app = Flask(__name__)
+
+class CafeApp(Flask):
+    # Hashed assets get a new name whenever their content changes, so browsers may keep them
+    # for a year. Every other static file keeps Flask's default max-age.
+    def get_send_file_max_age(self, filename):
+        if filename and is_hashed_asset(filename):
+            return 31536000
+        return super().get_send_file_max_age(filename)
+
+
+app = CafeApp(__name__)
 app.config['SECRET_KEY'] = os.environ.get('FLASK_KEY')
+# PBKDF2 iteration count is spelled out so it can be tuned against the login/register latency budget
+app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:600000')
+# Skip the (deliberately slow) PBKDF2 check for logins that succeeded recently
+app.config['USE_VERIFY_PASSWORD_CACHE'] = os.environ.get('USE_VERIFY_PASSWORD_CACHE') == '1'
+# Flask-WTF keeps one raw CSRF token per session; without a time limit the signed form
+# token stays valid for the whole session instead of expiring after an hour
+app.config['WTF_CSRF_TIME_LIMIT'] = None
+# Keep compiled template bytecode in the temp dir so new workers skip recompiling
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache()
+
+# Keep sessions in Redis when it is available, so only the session id travels in the cookie
+if os.environ.get('REDIS_URL'):
+    app.config.update(
+        SESSION_TYPE='redis',
+        SESSION_REDIS=redis.from_url(os.environ['REDIS_URL']),
+        # No SESSION_USE_SIGNER: Flask-Session 0.5 passes the signed id to set_cookie as
+        # bytes, which Werkzeug 3 rejects. The id is already a long random token.
+    )
+    Session(app)
+
+# Cache for rendered pages; shares Redis with the sessions when it is configured. Without
+# Redis it is a no-op, since a per-process cache.clear() would leave other workers stale.
+if os.environ.get('REDIS_URL'):
+    cache = Cache(app, config={'CACHE_TYPE': 'RedisCache', 'CACHE_REDIS_URL': os.environ['REDIS_URL'],
+                               'CACHE_KEY_PREFIX': 'cafes_cache_', 'CACHE_DEFAULT_TIMEOUT': 60})
+else:
+    cache = Cache(app, config={'CACHE_TYPE': 'NullCache'})
+
 ckeditor = CKEditor(app)
-Bootstrap5(app)
 
 # Configure Flask-Login
 login_manager = LoginManager()
@@ -24,58 +69,180 @@ login_manager.init_app(app)
 
 @login_manager.user_loader
 def load_user(user_id):
-    return db.get_or_404(User, user_id)
+    # Return None for a deleted user so Flask-Login logs them out instead of a 404
+    user = db.session.get(User, int(user_id))
+    if user:
+        # Keep the plain id around so checks like admin_only don't touch the ORM object
+        g.user_id = user.id
+    return user
 
 
-# For adding profile images to the comment section
-gravatar = Gravatar(app,
-                    size=100,
-                    rating='g',
-                    default='retro',
-                    force_default=False,
-                    force_lower=False,
-                    use_ssl=False,
-                    base_url=None)
 
 # CREATE DATABASE
 class Base(DeclarativeBase):
     pass
 
+# Number of cafes shown per page on the home page
+PAGE_SIZE = 20
+
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get("DB_URI", "sqlite:///cafes.db")
-db = SQLAlchemy(model_class=Base)
+# Check connections before use and recycle them before server/NAT idle timeouts drop them
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'pool_pre_ping': True, 'pool_recycle': 1800}
+# SQLite doesn't use a sized connection pool, so only set these for real database servers
+if not app.config['SQLALCHEMY_DATABASE_URI'].startswith("sqlite"):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'].update(pool_size=10, max_overflow=20)
+# Objects stay usable after commit without a reload SELECT; routes flush/commit explicitly
+db = SQLAlchemy(model_class=Base, session_options={'expire_on_commit': False, 'autoflush': False})
 db.init_app(app)
 
 # CONFIGURE TABLES
 # Create a User table for all your registered users
 class User(UserMixin, db.Model):
-    __table_name__ = "user"
+    __tablename__ = "user"
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     name: Mapped[str] = mapped_column(String(100))
-    email: Mapped[str] = mapped_column(String(100), unique=True)
-    password: Mapped[str] = mapped_column(String(100))
-    cafes: Mapped["Cafe"] = relationship(back_populates="user")
+    email: Mapped[str] = mapped_column(String(254), unique=True, index=True)
+    password: Mapped[str] = mapped_column(String(255))
+    # MD5 of the normalised email, stored so avatar URLs don't need hashing on every render.
+    # Nullable so the column can be added to an existing table; init-db fills in old rows.
+    email_md5: Mapped[str] = mapped_column(String(32), nullable=True)
+    cafes: Mapped[list["Cafe"]] = relationship(back_populates="user")
 
 class Cafe(db.Model):
-    __table_name__ = "cafes"
+    __tablename__ = "cafes"
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     name: Mapped[str] = mapped_column(String(250), unique=True, nullable=False)
     address: Mapped[str] = mapped_column(String(250), nullable=False)
     hours: Mapped[str] = mapped_column(String(250), nullable=False)
-    location: Mapped[str] = mapped_column(Text, nullable=False)
+    location: Mapped[str] = mapped_column(String(500), nullable=False)
     user_id: Mapped[int] = mapped_column(ForeignKey("user.id"))
     user: Mapped["User"] = relationship(back_populates="cafes")
 
 
-with app.app_context():
+# Create the tables once with `flask --app main init-db` instead of on every worker boot
+@app.cli.command('init-db')
+def init_db():
     db.create_all()
+    # Backfill users registered before email_md5 existed
+    for user in db.session.scalars(db.select(User).where(User.email_md5.is_(None))):
+        user.email_md5 = gravatar_hash(user.email)
+    db.session.commit()
+    click.echo("Initialized the database.")
+
+
+def gravatar_hash(email):
+    return hashlib.md5(email.strip().lower().encode()).hexdigest()
+
+
+# Run `flask --app main smoke-check` after deploying to exercise the configured session backend
+@app.cli.command('smoke-check')
+def smoke_check():
+    client = app.test_client()
+    # The login form stores a CSRF token, so this request has to save the session
+    response = client.get('/login')
+    if response.status_code != 200 or 'session=' not in response.headers.get('Set-Cookie', ''):
+        raise click.ClickException(f"GET /login returned {response.status}, no session cookie set.")
+    click.echo(f"Sessions OK ({type(app.session_interface).__name__}).")
+    # Hashed assets must be cached for a year whether or not they are sent gzipped
+    for hashed_filename in asset_manifest.values():
+        for encoding in ('identity', 'gzip'):
+            response = client.get(f"{app.static_url_path}/{hashed_filename}", headers={'Accept-Encoding': encoding})
+            response.close()
+            cache_control = response.headers.get('Cache-Control', '')
+            if 'max-age=31536000' not in cache_control or 'immutable' not in cache_control:
+                raise click.ClickException(f"{hashed_filename} ({encoding}) sent Cache-Control: {cache_control}")
+    click.echo(f"Cache headers OK for {len(asset_manifest)} hashed assets.")
+
+
+# Static files that change between deploys and get a content hash in their name
+HASHED_ASSETS = ('css/styles.css', 'js/scripts.js')
+ASSET_MANIFEST_PATH = os.path.join(app.static_folder, 'manifest.json')
+
+
+# Run `flask --app main build-assets` on deploy to write hashed copies (plus .gz) and the manifest
+@app.cli.command('build-assets')
+def build_assets():
+    manifest = {}
+    for filename in HASHED_ASSETS:
+        with open(os.path.join(app.static_folder, filename), 'rb') as f:
+            data = f.read()
+        root, ext = os.path.splitext(filename)
+        hashed_filename = f"{root}.{hashlib.sha256(data).hexdigest()[:10]}{ext}"
+        with open(os.path.join(app.static_folder, hashed_filename), 'wb') as f:
+            f.write(data)
+        with open(os.path.join(app.static_folder, hashed_filename + '.gz'), 'wb') as f:
+            f.write(gzip.compress(data, compresslevel=9, mtime=0))
+        manifest[filename] = hashed_filename
+    with open(ASSET_MANIFEST_PATH, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    click.echo(f"Built {len(manifest)} assets.")
+
+
+# Maps a static filename to its hashed name; empty until build-assets has been run
+if os.path.isfile(ASSET_MANIFEST_PATH):
+    with open(ASSET_MANIFEST_PATH) as f:
+        asset_manifest = json.load(f)
+else:
+    asset_manifest = {}
+
+
+@app.template_global()
+def asset(filename):
+    return url_for('static', filename=asset_manifest.get(filename, filename))
+
+
+def is_hashed_asset(filename):
+    return filename.removesuffix('.gz') in asset_manifest.values()
+
+
+# Registered before gzip_static so it runs after it and also marks the .gz response
+@app.after_request
+def mark_hashed_assets_immutable(response):
+    if request.endpoint == 'static' and is_hashed_asset(request.view_args['filename']):
+        response.cache_control.immutable = True
+    return response
+
+
+# Eager-load options shared by the cafe queries. In debug (or with RAISELOAD=1) any
+# relationship that wasn't loaded up front raises instead of quietly running a query.
+def cafe_load_options():
+    # Each cafe has exactly one user, so a JOIN fetches both in one query without duplicating rows
+    options = [joinedload(Cafe.user)]
+    if app.debug or os.environ.get("RAISELOAD") == "1":
+        options.append(raiseload("*"))
+    return options
+
+
+# Recently verified (password, hash) pairs, keyed by a SHA-256 digest of the pair.
+# A bigger maxsize or longer ttl saves more PBKDF2 work, but each entry is a fast,
+# non-KDF hash of a plaintext password kept in process memory, which is far cheaper
+# to brute-force than the stored PBKDF2 hash.
+_pw_cache = TTLCache(maxsize=1024, ttl=60)
+# TTLCache isn't thread-safe: lookups and inserts both expire entries
+_pw_cache_lock = threading.Lock()
+
+
+def verify_password(password, password_hash):
+    if not app.config['USE_VERIFY_PASSWORD_CACHE']:
+        return check_password_hash(password_hash, password)
+    key = hashlib.sha256((password + password_hash).encode()).digest()
+    with _pw_cache_lock:
+        if key in _pw_cache:
+            return True
+    if check_password_hash(password_hash, password):
+        with _pw_cache_lock:
+            _pw_cache[key] = True
+        return True
+    return False
 
 
 # Create an admin-only decorator
 def admin_only(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        # If id is not 1 then return abort with 403 error
-        if current_user.id != 1:
+        # If id is not 1 then return abort with 403 error.
+        # is_authenticated makes Flask-Login run load_user, which sets g.user_id.
+        if not current_user.is_authenticated or g.get('user_id') != 1:
             return abort(403)
         # Otherwise continue with the route function
         return f(*args, **kwargs)
@@ -83,6 +250,38 @@ def admin_only(f):
     return decorated_function
 
 
+# Let browsers revalidate the cafe list with an ETag and get a 304 when nothing changed.
+# Pages with a form embed a fresh CSRF token on every render, so an ETag never matches there.
+@app.after_request
+def add_etag(response):
+    if request.endpoint == 'get_all_cafes' and request.method == 'GET' and response.status_code == 200:
+        response.set_etag(hashlib.blake2b(response.get_data()).hexdigest()[:16])
+        response.make_conditional(request)
+    return response
+
+
+# Serve the gzip copy of a static file (written next to the hashed assets by build-assets)
+# to browsers that accept it
+@app.after_request
+def gzip_static(response):
+    if request.endpoint != 'static':
+        return response
+    gz_filename = request.view_args['filename'] + '.gz'
+    if not os.path.isfile(os.path.join(app.static_folder, gz_filename)):
+        return response
+    # Both variants share the URL, so caches must key on Accept-Encoding
+    response.vary.add('Accept-Encoding')
+    if response.status_code != 200 or 'gzip' not in request.headers.get('Accept-Encoding', ''):
+        return response
+    response.close()
+    # Pass max_age explicitly: otherwise Werkzeug calls get_send_file_max_age with the absolute path
+    gz_response = send_from_directory(app.static_folder, gz_filename, mimetype=response.mimetype,
+                                      max_age=app.get_send_file_max_age(gz_filename))
+    gz_response.headers['Content-Encoding'] = 'gzip'
+    gz_response.vary.add('Accept-Encoding')
+    return gz_response
+
+
 # Register new users into the User database
 @app.route('/register', methods=["GET", "POST"])
 def register():
@@ -90,8 +289,7 @@ def register():
     if form.validate_on_submit():
 
         # Check if user email is already present in the database.
-        result = db.session.execute(db.select(User).where(User.email == form.email.data))
-        user = result.scalar()
+        user = db.session.scalar(db.select(User).where(User.email == form.email.data))
         if user:
             # User already exists
             flash("You've already signed up with that email, log in instead!")
@@ -99,11 +297,12 @@ def register():
 
         hash_and_salted_password = generate_password_hash(
             form.password.data,
-            method='pbkdf2:sha256',
+            method=app.config['PASSWORD_HASH_METHOD'],
             salt_length=8
         )
         new_user = User(
             email=form.email.data,
+            email_md5=gravatar_hash(form.email.data),
             name=form.name.data,
             password=hash_and_salted_password,
         )
@@ -120,15 +319,14 @@ def login():
     form = LoginForm()
     if form.validate_on_submit():
         password = form.password.data
-        result = db.session.execute(db.select(User).where(User.email == form.email.data))
         # Note, email in db is unique so will only have one result.
-        user = result.scalar()
+        user = db.session.scalar(db.select(User).where(User.email == form.email.data))
         # Email doesn't exist
         if not user:
             flash("That email does not exist, please try again.")
             return redirect(url_for('login'))
         # Password incorrect
-        elif not check_password_hash(user.password, password):
+        elif not verify_password(password, user.password):
             flash('Password incorrect, please try again.')
             return redirect(url_for('login'))
         else:
@@ -145,10 +343,27 @@ def logout():
 
 
 @app.route('/')
+# Anonymous visitors get a cached copy; logged in users see their own nav bar
+@cache.cached(timeout=30, query_string=True, unless=lambda: current_user.is_authenticated)
 def get_all_cafes():
-    result = db.session.execute(db.select(Cafe))
+    # Keyset pagination: ?after=<id> returns the cafes following that id, so the
+    # database never has to skip over earlier rows like it would with OFFSET.
+    after = request.args.get('after', 0, type=int)
+    # Load each cafe's user up front so the template doesn't fire one query per cafe
+    result = db.session.execute(
+        db.select(Cafe)
+        .options(*cafe_load_options())
+        .where(Cafe.id > after)
+        .order_by(Cafe.id)
+        .limit(PAGE_SIZE + 1)
+    )
     cafes = result.scalars().all()
-    return render_template("index.html", all_cafes=cafes, current_user=current_user)
+    # One extra row was fetched to tell whether there is another page
+    has_next = len(cafes) > PAGE_SIZE
+    cafes = cafes[:PAGE_SIZE]
+    next_after = cafes[-1].id if has_next else None
+    return render_template("index.html", all_cafes=cafes, has_next=has_next, next_after=next_after,
+                           current_user=current_user)
 
 
 
@@ -167,6 +382,8 @@ def add_new_cafe():
         )
         db.session.add(new_cafe)
         db.session.commit()
+        # The cafe list changed, drop the cached home pages
+        cache.clear()
         return redirect(url_for('thank_you'))
     return render_template("make-post.html", form=form, current_user=current_user)
 
@@ -174,7 +391,7 @@ def add_new_cafe():
 @app.route("/edit-cafe/<int:cafe_id>", methods=["GET", "POST"])
 @admin_only
 def edit_cafe(cafe_id):
-    cafes = db.get_or_404(Cafe, cafe_id)
+    cafes = db.first_or_404(db.select(Cafe).where(Cafe.id == cafe_id).options(*cafe_load_options()))
     edit_form = CreatePostForm(
         name=cafes.name,
         address=cafes.address,
@@ -188,6 +405,8 @@ def edit_cafe(cafe_id):
         cafes.hours = edit_form.hours.data
         cafes.location = edit_form.location.data
         db.session.commit()
+        # The cafe list changed, drop the cached home pages
+        cache.clear()
         return redirect(url_for("show_post", cafes_id=cafes.id))
     return render_template("make-post.html", form=edit_form, is_edit=True, current_user=current_user)
 
@@ -196,9 +415,11 @@ def edit_cafe(cafe_id):
 @app.route("/delete/<int:cafe_id>")
 @admin_only
 def delete_cafe(cafe_id):
-    cafe_to_delete = db.get_or_404(Cafe, cafe_id)
+    cafe_to_delete = db.first_or_404(db.select(Cafe).where(Cafe.id == cafe_id).options(*cafe_load_options()))
     db.session.delete(cafe_to_delete)
     db.session.commit()
+    # The cafe list changed, drop the cached home pages
+    cache.clear()
     return redirect(url_for('get_all_cafes'))
 
 
@@ -211,6 +432,12 @@ def thank_you():
     return render_template("thank-you.html", current_user=current_user)
 
 
+# Compile the templates at startup rather than on each worker's first request, including
+# the header, footer and form macro that every page includes or imports
+for template_name in ('index.html', 'login.html', 'register.html', 'make-post.html', 'cafes.html', 'thank-you.html',
+                      'header.html', 'footer.html', 'form.html'):
+    app.jinja_env.get_template(template_name)
+
 
 if __name__ == "__main__":
     app.run(debug=False, port=5001)
\ No newline at end of file